@@ -1,58 +1,188 @@
-from flask import Flask, render_template, redirect, url_for, request, flash
+from flask import Flask, render_template, redirect, url_for, request, flash, abort, make_response, session
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from flask_compress import Compress
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, func, inspect, lambda_stmt, or_, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, raiseload
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SelectField, TextAreaField
+from wtforms import StringField, PasswordField, SelectField, TextAreaField, IntegerField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, NumberRange
+import functools
+import hashlib
 import os
+from dotenv import load_dotenv
+
+load_dotenv()
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
+# Read once at startup; set it in the environment or a .env file
+app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///movies.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Shared by both engines; Flask-SQLAlchemy doesn't apply SQLALCHEMY_ENGINE_OPTIONS to binds
+engine_options = {
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+    'connect_args': {'check_same_thread': False}
+}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    **engine_options,
+    'pool_size': 10,
+    'max_overflow': 20
+}
+# Read-only bind on the same file for GET views; WAL lets it read while the default engine writes
+app.config['SQLALCHEMY_BINDS'] = {
+    'ro': {
+        **engine_options,
+        'url': 'sqlite:///movies.db',
+        'pool_size': 20,
+        'max_overflow': 40
+    }
+}
+
+# Strip the whitespace around block tags when templates compile rather than shipping it on every render
+app.jinja_options = {**app.jinja_options, 'trim_blocks': True, 'lstrip_blocks': True}
+# Kept in the instance folder (not a shared temp dir) and keyed on the Jinja options,
+# since compiled bytecode depends on them but the cache only checks template source
+jinja_options_key = hashlib.sha1(repr(sorted(app.jinja_options.items())).encode()).hexdigest()[:12]
+jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache', jinja_options_key)
+os.makedirs(jinja_cache_dir, mode=0o700, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
 
 db = SQLAlchemy(app)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-20000')
+    cursor.close()
+
+def set_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+# db.engines needs an app context with Flask-SQLAlchemy 3
+with app.app_context():
+    for engine in db.engines.values():
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    event.listen(db.engines['ro'], 'connect', set_query_only)
+
+def read_only():
+    return {'bind': db.engines['ro']}
+
+@functools.cache
+def template_version():
+    # Changes whenever a template or the Jinja options change, so cached pages expire on deploy
+    digest = hashlib.sha1(jinja_options_key.encode())
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, name)
+        digest.update(name.encode())
+        digest.update(source.encode())
+    return digest.hexdigest()[:12]
+
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# Verified against when the username doesn't exist so login takes the same time either way
+DUMMY_HASH = password_hasher.hash('dummy-password')
+
 # Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
-    reviews = db.relationship('Review', backref='author', lazy=True)
+    reviews = db.relationship('Review', back_populates='author', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # Accounts registered before the switch to argon2 still hold werkzeug hashes
+        is_legacy = not self.password_hash.startswith('$argon2')
+        if is_legacy:
+            valid = check_password_hash(self.password_hash, password)
+        else:
+            try:
+                valid = password_hasher.verify(self.password_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+        # Move legacy hashes and outdated argon2 parameters onto the current hasher,
+        # so verifying costs the same as the dummy verify for unknown usernames
+        if valid and (is_legacy or password_hasher.check_needs_rehash(self.password_hash)):
+            self.set_password(password)
+        return valid
 
 class Movie(db.Model):
+    __table_args__ = (db.Index('ix_movie_title', 'title'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     year = db.Column(db.Integer, nullable=False)
     genre = db.Column(db.String(50), nullable=False)
     director = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
+    # Kept in step with the reviews in add_review so averages need no Review scan
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
     reviews = db.relationship('Review', backref='movie', lazy=True)
 
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
 class Review(db.Model):
+    # Covers movie_detail's filter on movie_id ordered by timestamp
+    __table_args__ = (db.Index('ix_review_movie_ts', 'movie_id', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'), nullable=False)
+    author = db.relationship('User', back_populates='reviews')
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login already calls this once per request; get() checks the identity map first
+    return db.session.get(User, int(user_id))
 
 # Forms
+GENRE_CHOICES = (
+    ('action', 'Action'),
+    ('comedy', 'Comedy'),
+    ('drama', 'Drama'),
+    ('horror', 'Horror'),
+    ('sci-fi', 'Science Fiction'),
+    ('thriller', 'Thriller'),
+    ('other', 'Other')
+)
+
+RATING_CHOICES = (
+    (1, '1 - Poor'),
+    (2, '2 - Fair'),
+    (3, '3 - Good'),
+    (4, '4 - Very Good'),
+    (5, '5 - Excellent')
+)
+
 class RegistrationForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=4, max=25)])
     email = StringField('Email', validators=[DataRequired(), Email(), Length(min=6, max=100)])
@@ -66,39 +196,63 @@ class LoginForm(FlaskForm):
 
 class MovieForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(max=100)])
-    year = StringField('Year', validators=[DataRequired(), Length(min=4, max=4)])
-    genre = SelectField('Genre', choices=[
-        ('action', 'Action'),
-        ('comedy', 'Comedy'),
-        ('drama', 'Drama'),
-        ('horror', 'Horror'),
-        ('sci-fi', 'Science Fiction'),
-        ('thriller', 'Thriller'),
-        ('other', 'Other')
-    ], validators=[DataRequired()])
+    year = IntegerField('Year', validators=[DataRequired(), NumberRange(min=1888, max=2100)])
+    genre = SelectField('Genre', choices=GENRE_CHOICES, validators=[DataRequired()])
     director = StringField('Director', validators=[DataRequired(), Length(max=100)])
     description = TextAreaField('Description')
 
 class ReviewForm(FlaskForm):
-    rating = SelectField('Rating', choices=[
-        (1, '1 - Poor'),
-        (2, '2 - Fair'),
-        (3, '3 - Good'),
-        (4, '4 - Very Good'),
-        (5, '5 - Excellent')
-    ], validators=[DataRequired()], coerce=int)
+    rating = SelectField('Rating', choices=RATING_CHOICES, validators=[DataRequired()], coerce=int)
     comment = TextAreaField('Comment', validators=[Length(max=500)])
 
 # Routes
 @app.route('/')
 def index():
-    movies = Movie.query.order_by(Movie.title).all()
-    return render_template('index.html', movies=movies)
+    # Movies are only ever added, so the count and newest id identify the catalog.
+    # The navbar depends on who is logged in, and the markup on the deployed templates.
+    movie_count, last_movie_id = db.session.execute(
+        select(func.count(Movie.id), func.max(Movie.id)),
+        bind_arguments=read_only()
+    ).one()
+    etag = f'{template_version()}-{movie_count}-{last_movie_id}-{current_user.get_id() or "anonymous"}'
+    # Flask-Compress suffixes the tag with the encoding it used, e.g. "...:gzip"
+    known_etags = [etag] + [f'{etag}:{algorithm}' for algorithm in app.config['COMPRESS_ALGORITHM']]
+    # A page showing flash messages must never be revalidated: a 304 would swallow
+    # pending messages, and a tagged flash page would be replayed on later visits
+    has_flashes = '_flashes' in session
+    if not has_flashes and any(request.if_none_match.contains(tag) for tag in known_etags):
+        response = make_response('', 304)
+    else:
+        # Called from inside the cached fragment, so a cache hit skips the query too
+        def load_movies():
+            # Only the columns the grid shows, as plain rows rather than ORM objects
+            return db.session.execute(
+                select(Movie.id, Movie.title, Movie.year, Movie.genre, Movie.director).order_by(Movie.title),
+                bind_arguments=read_only()
+            ).all()
+        response = make_response(render_template(
+            'index.html', load_movies=load_movies, movie_count=movie_count, last_movie_id=last_movie_id
+        ))
+    if has_flashes:
+        response.headers['Cache-Control'] = 'no-store'
+    else:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
 
 @app.route('/movie/<int:movie_id>')
 def movie_detail(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
-    reviews = Review.query.filter_by(movie_id=movie_id).order_by(Review.timestamp.desc()).all()
+    movie = db.session.get(Movie, movie_id, bind_arguments=read_only())
+    if movie is None:
+        abort(404)
+    # lambda_stmt caches the built statement and its compiled SQL; movie_id becomes a bound parameter
+    stmt = lambda_stmt(lambda: select(Review).options(joinedload(Review.author)))
+    if app.debug:
+        # Surface accidental lazy loads (N+1s) in development instead of silently querying
+        stmt += lambda s: s.options(raiseload('*'))
+    stmt += lambda s: s.where(Review.movie_id == movie_id).order_by(Review.timestamp.desc())
+    reviews = db.session.scalars(stmt, bind_arguments=read_only()).all()
     return render_template('movie_detail.html', movie=movie, reviews=reviews)
 
 @app.route('/add_movie', methods=['GET', 'POST'])
@@ -132,6 +286,9 @@ def add_review(movie_id):
             movie_id=movie_id
         )
         db.session.add(review)
+        # SQL-side increments so concurrent reviews don't overwrite each other
+        movie.rating_sum = Movie.rating_sum + review.rating
+        movie.rating_count = Movie.rating_count + 1
         db.session.commit()
         flash('Your review has been added!', 'success')
         return redirect(url_for('movie_detail', movie_id=movie_id))
@@ -141,12 +298,22 @@ def add_review(movie_id):
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
-        db.session.add(user)
-        db.session.commit()
-        flash('Registration successful! Please log in.', 'success')
-        return redirect(url_for('login'))
+        # Check the unique columns before paying for the hash and a write that would fail
+        taken = db.session.execute(
+            select(User.id).where(or_(User.username == form.username.data, User.email == form.email.data))
+        ).first()
+        if taken is None:
+            user = User(username=form.username.data, email=form.email.data)
+            user.set_password(form.password.data)
+            db.session.add(user)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+            else:
+                flash('Registration successful! Please log in.', 'success')
+                return redirect(url_for('login'))
+        flash('Username or email is already registered', 'danger')
     return render_template('register.html', form=form)
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -154,7 +321,15 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data):
+        if user is None:
+            try:
+                password_hasher.verify(DUMMY_HASH, form.password.data)
+            except VerificationError:
+                pass
+        elif user.check_password(form.password.data):
+            if db.session.is_modified(user):
+                # check_password upgraded the stored hash
+                db.session.commit()
             login_user(user)
             return redirect(url_for('index'))
         flash('Invalid username or password', 'danger')
@@ -166,10 +341,20 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
-# Create necessary directories and files
-os.makedirs('templates', exist_ok=True)
+# The navbar links on every page only change with the mount point (SCRIPT_NAME or
+# X-Forwarded-Prefix), so build them once per script root instead of per render
+static_urls_by_root = {}
+
+@app.context_processor
+def inject_static_urls():
+    script_root = request.script_root
+    if script_root not in static_urls_by_root:
+        static_urls_by_root[script_root] = {
+            endpoint: url_for(endpoint) for endpoint in ('index', 'login', 'register', 'add_movie', 'logout')
+        }
+    return {'STATIC_URLS': static_urls_by_root[script_root]}
 
-# Basic templates
+# Basic templates, written out by write_templates() rather than on every import
 templates = {
     'base.html': '''<!DOCTYPE html>
 <html>
@@ -181,14 +366,14 @@ templates = {
 <body>
     <nav class="navbar navbar-expand-lg navbar-dark bg-dark">
         <div class="container">
-            <a class="navbar-brand" href="{{ url_for('index') }}">Movie Ratings</a>
+            <a class="navbar-brand" href="{{ STATIC_URLS['index'] }}">Movie Ratings</a>
             <div class="navbar-nav">
                 {% if current_user.is_authenticated %}
-                    <a class="nav-link" href="{{ url_for('add_movie') }}">Add Movie</a>
-                    <a class="nav-link" href="{{ url_for('logout') }}">Logout</a>
+                    <a class="nav-link" href="{{ STATIC_URLS['add_movie'] }}">Add Movie</a>
+                    <a class="nav-link" href="{{ STATIC_URLS['logout'] }}">Logout</a>
                 {% else %}
-                    <a class="nav-link" href="{{ url_for('login') }}">Login</a>
-                    <a class="nav-link" href="{{ url_for('register') }}">Register</a>
+                    <a class="nav-link" href="{{ STATIC_URLS['login'] }}">Login</a>
+                    <a class="nav-link" href="{{ STATIC_URLS['register'] }}">Register</a>
                 {% endif %}
             </div>
         </div>
@@ -210,7 +395,8 @@ templates = {
 {% block content %}
 <h2>Movie List</h2>
 <div class="row">
-    {% for movie in movies %}
+    {% cache 300, 'movie_list', movie_count|string, last_movie_id|string %}
+    {% for movie in load_movies() %}
     <div class="col-md-4 mb-4">
         <div class="card">
             <div class="card-body">
@@ -222,6 +408,7 @@ templates = {
         </div>
     </div>
     {% endfor %}
+    {% endcache %}
 </div>
 {% endblock %}''',
     
@@ -231,6 +418,9 @@ templates = {
 <p><strong>Genre:</strong> {{ movie.genre|title }}</p>
 <p><strong>Director:</strong> {{ movie.director }}</p>
 <p>{{ movie.description }}</p>
+{% if movie.rating_count %}
+<p><strong>Average Rating:</strong> {{ '%.1f'|format(movie.average_rating) }}/5 ({{ movie.rating_count }} reviews)</p>
+{% endif %}
 
 <h3>Reviews</h3>
 {% if current_user.is_authenticated %}
@@ -337,13 +527,56 @@ templates = {
 {% endblock %}'''
 }
 
-for filename, content in templates.items():
-    path = os.path.join('templates', filename)
-    if not os.path.exists(path):
-        with open(path, 'w') as f:
-            f.write(content)
+def write_templates():
+    template_dir = os.path.join(app.root_path, 'templates')
+    os.makedirs(template_dir, exist_ok=True)
+    for filename, content in templates.items():
+        path = os.path.join(template_dir, filename)
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(content)
 
-if __name__ == '__main__':
+@app.cli.command('init-templates')
+def init_templates_command():
+    """Write any missing templates to the templates folder."""
+    write_templates()
+
+def upgrade_db():
+    # create_all() never alters tables that already exist, so add what later versions need
+    db.create_all()
+    with db.engine.begin() as connection:
+        movie_columns = {column['name'] for column in inspect(connection).get_columns('movie')}
+        for name in ('rating_sum', 'rating_count'):
+            if name not in movie_columns:
+                connection.execute(text(f'ALTER TABLE movie ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0'))
+        # Recount from the reviews so movies reviewed before the columns existed are correct
+        connection.execute(text(
+            'UPDATE movie SET '
+            'rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM review WHERE review.movie_id = movie.id), '
+            'rating_count = (SELECT COUNT(*) FROM review WHERE review.movie_id = movie.id)'
+        ))
+        for index in Movie.__table__.indexes | Review.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes and recount movie ratings."""
+    upgrade_db()
+
+def prepare():
+    """One-time startup work, run before serving (and before gunicorn forks with --preload)."""
+    write_templates()
     with app.app_context():
-        db.create_all()
+        upgrade_db()
+        # Forked workers must not share connections opened here
+        for engine in db.engines.values():
+            engine.dispose()
+    # Compile every template up front so the first request doesn't pay for it
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    template_version()
+
+# Production: gunicorn app:app (settings in gunicorn.conf.py)
+if __name__ == '__main__':
+    prepare()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,11 @@
+# Picked up automatically by `gunicorn app:app`
+worker_class = 'gthread'
+workers = 2
+threads = 8
+# Import the app once in the master so workers inherit the compiled templates
+preload_app = True
+
+
+def when_ready(server):
+    from app import prepare
+    prepare()